@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 
 import rclpy
+from rclpy.clock import Clock, ClockType
+from rclpy.executors import ExternalShutdownException
 from rclpy.node import Node
+from rclpy.qos import HistoryPolicy, QoSProfile, ReliabilityPolicy
+from rclpy.serialization import serialize_message
+from rclpy.signals import SignalHandlerOptions
 from geometry_msgs.msg import Twist
 import threading
+import math
+import selectors
+import signal
 import time
 import sys
 import os
@@ -13,79 +21,215 @@ class VelocityTestNode(Node):
     def __init__(self):
         super().__init__('velocity_test_node')
         
-        # Create publisher for cmd_vel topic
-        self.cmd_vel_publisher = self.create_publisher(Twist, 'cmd_vel', 10)
+        # Create publisher for cmd_vel topic. Depth 1 keeps stale commands from
+        # queuing behind a newer one, e.g. a forward command ahead of a stop
+        cmd_vel_qos = QoSProfile(
+            reliability=ReliabilityPolicy.RELIABLE,
+            history=HistoryPolicy.KEEP_LAST,
+            depth=1
+        )
+        self.cmd_vel_publisher = self.create_publisher(Twist, 'cmd_vel', cmd_vel_qos)
+        self._publish_cmd_vel = self.cmd_vel_publisher.publish  # Bound once for the tick
         
         # Initialize Twist message
         self.twist_msg = Twist()
+        self._twist_bytes = serialize_message(self.twist_msg)
+        self._last_sent = (0.0, 0.0)  # (linear.x, angular.z) held in twist_msg
+        self._stop_bytes = serialize_message(Twist())  # All fields default to zero
         
         # Control variables
         self.is_publishing = False
         self.test_mode = None  # 'linear' or 'angular'
-        self.ui_lock = threading.Lock()  # Prevent output conflicts
+        self._last_params = {}  # Last accepted (velocity, duration) per test label
+        self._timer = None
+        self._tick_rate = 10.0  # Hz
+        self._timer_clock = Clock(clock_type=ClockType.STEADY_TIME)
+        self._remaining = 0
+        self._start_time = None
+        
+        # Tests requested by the UI thread, started from the executor thread
+        self._job_cv = threading.Condition()
+        self._job = None
+        self._job_done = False
+        self._job_guard = self.create_guard_condition(self._drain_jobs)
         
         # Reduce ROS2 log level to minimize console output during user input
         self.get_logger().set_level(rclpy.logging.LoggingSeverity.WARN)
         
         print("Velocity Test Node initialized")
         
+        # Test progress is written pre-encoded straight to the stdout buffer
+        self._write_stdout = sys.stdout.buffer.write
+        self._flush_stdout = sys.stdout.buffer.flush
+        self._progress_line = '► Test in progress...'.encode()
+        self._completed_line = '\r► Test completed! Published for %.2f seconds\n'.encode()
+        
+        # Poll stdin so the UI thread notices shutdown instead of blocking in input().
+        # Lines are split from unbuffered reads so select() sees all pending input.
+        # epoll rejects regular files and /dev/null, which never block anyway, so
+        # those are read directly.
+        self._stdin_fd = sys.stdin.fileno()
+        self._stdin_buf = b''
+        self._sel = selectors.DefaultSelector()
+        try:
+            self._sel.register(self._stdin_fd, selectors.EVENT_READ)
+            self._stdin_polled = True
+        except OSError:
+            self._stdin_polled = False
+        
+        # rclpy's signal handler is disabled so the context outlives Ctrl-C, which
+        # leaves nothing to wake an idle executor. Python's signal wakeup fd is
+        # polled with stdin and the UI thread triggers a guard condition instead.
+        self._wake_fd, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_w, False)
+        signal.set_wakeup_fd(self._wake_w, warn_on_full_buffer=False)
+        self._sel.register(self._wake_fd, selectors.EVENT_READ)
+        
         # Start the user interface in a separate thread
         self.ui_thread = threading.Thread(target=self.user_interface, daemon=True)
         self.ui_thread.start()
 
+    def destroy_node(self):
+        """
+        Release the signal wakeup pipe along with the node
+        """
+        signal.set_wakeup_fd(-1)
+        os.close(self._wake_w)
+        os.close(self._wake_fd)
+        super().destroy_node()
+
     def publish_velocity(self, linear_vel=0.0, angular_vel=0.0, duration=1.0):
         """
         Publish velocity for a specified duration
         """
         self.is_publishing = True
         
-        # Set velocities
-        self.twist_msg.linear.x = linear_vel
-        self.twist_msg.linear.y = 0.0
-        self.twist_msg.linear.z = 0.0
-        self.twist_msg.angular.x = 0.0
-        self.twist_msg.angular.y = 0.0
-        self.twist_msg.angular.z = angular_vel
-        
-        with self.ui_lock:
-            print(f'► Starting test - Linear: {linear_vel} m/s, Angular: {angular_vel} rad/s for {duration} seconds')
-            print('► Test in progress...', end='', flush=True)
+        # A repeated command reuses the message already serialized for it
+        velocities = (float(linear_vel), float(angular_vel))
+        if velocities != self._last_sent:
+            self._last_sent = velocities
+            
+            # Set velocities; the remaining fields are never changed from zero
+            self.twist_msg.linear.x, self.twist_msg.angular.z = velocities
+            
+            # Serialize once per command; every tick then publishes the raw buffer
+            self._twist_bytes = serialize_message(self.twist_msg)
         
-        # Record start time
-        start_time = time.time()
+        self._write_stdout(f'► Starting test - Linear: {linear_vel} m/s, Angular: {angular_vel} '
+                           f'rad/s for {duration} seconds\n'.encode())
+        self._write_stdout(self._progress_line)
+        self._flush_stdout()
         
-        # Publish at 10 Hz during the duration
-        rate = 10.0  # Hz
-        sleep_time = 1.0 / rate
+        # Publish at 10 Hz from a timer so the executor drives the cadence
+        self._start_time = time.monotonic_ns()
+        self._remaining = max(1, int(duration * self._tick_rate))
+        self._timer = self.create_timer(
+            1.0 / self._tick_rate, self._on_tick, clock=self._timer_clock)
+        self._on_tick()
+
+    def _on_tick(self):
+        """
+        Publish one velocity command, or stop the robot once the test is over
+        """
+        if self._remaining > 0:
+            self._publish_cmd_vel(self._twist_bytes)
+            self._remaining -= 1
+            return
         
-        while (time.time() - start_time) < duration and self.is_publishing:
-            self.cmd_vel_publisher.publish(self.twist_msg)
-            time.sleep(sleep_time)
+        # The final tick sends the zero command in place of the velocity
+        self._publish_cmd_vel(self._stop_bytes)
         
-        # Stop the robot
-        self.stop_robot()
+        self._timer.cancel()
+        self.destroy_timer(self._timer)
+        self._timer = None
         
-        with self.ui_lock:
-            print(f'\r► Test completed! Published for {time.time() - start_time:.2f} seconds')
+        elapsed = (time.monotonic_ns() - self._start_time) * 1e-9
+        self._write_stdout(self._completed_line % elapsed)
+        self._flush_stdout()
         
         self.is_publishing = False
+        with self._job_cv:
+            self._job_done = True
+            self._job_cv.notify_all()
 
-    def stop_robot(self):
+    def _drain_jobs(self):
+        """
+        Start the next test queued by the user interface thread
         """
-        Send zero velocities to stop the robot
+        if self.is_publishing:
+            return
+        with self._job_cv:
+            job, self._job = self._job, None
+        if job is not None:
+            self.publish_velocity(*job)
+
+    def run_test(self, linear_vel, angular_vel, duration):
         """
-        stop_msg = Twist()
-        stop_msg.linear.x = 0.0
-        stop_msg.linear.y = 0.0
-        stop_msg.linear.z = 0.0
-        stop_msg.angular.x = 0.0
-        stop_msg.angular.y = 0.0
-        stop_msg.angular.z = 0.0
+        Hand a test over to the executor thread and wait for it to finish
+        """
+        with self._job_cv:
+            self._job = (linear_vel, angular_vel, duration)
+            self._job_done = False
+        self._job_guard.trigger()
         
-        # Send stop command multiple times to ensure it's received
-        for _ in range(5):
-            self.cmd_vel_publisher.publish(stop_msg)
-            time.sleep(0.1)
+        with self._job_cv:
+            while not self._job_done:
+                if not rclpy.ok():
+                    return
+                self._job_cv.wait(timeout=0.1)
+
+    def stop_robot(self):
+        """
+        Send zero velocities to stop the robot if a test is cut short
+        """
+        # cmd_vel is RELIABLE, so a single stop is retransmitted until acknowledged
+        self._publish_cmd_vel(self._stop_bytes)
+
+    def _prompt(self, prompt):
+        """
+        Read a line from stdin, or return None on EOF or node shutdown
+        """
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+        while rclpy.ok():
+            line, newline, rest = self._stdin_buf.partition(b'\n')
+            if newline:
+                self._stdin_buf = rest
+                return line.decode(errors='replace')
+            if self._stdin_polled:
+                ready = [key.fd for key, _ in self._sel.select(timeout=0.1)]
+                if self._wake_fd in ready:
+                    # Return the main thread to Python so it raises KeyboardInterrupt
+                    os.read(self._wake_fd, 512)
+                    self._job_guard.trigger()
+                if self._stdin_fd not in ready:
+                    continue
+            data = os.read(self._stdin_fd, 4096)
+            if not data:
+                # EOF; hand back a last line without a newline once
+                line, self._stdin_buf = self._stdin_buf, b''
+                return line.decode(errors='replace') if line else None
+            self._stdin_buf += data
+        return None
+
+    def _prompt_float(self, prompt, allow_empty=False):
+        """
+        Read a number from stdin, asking again for just this value on bad input
+        """
+        while True:
+            line = self._prompt(prompt)
+            if line is None:
+                return None
+            line = line.strip()
+            if not line and allow_empty:
+                return ''
+            try:
+                value = float(line)
+            except ValueError:
+                value = math.nan
+            if math.isfinite(value):
+                return value
+            print("Please enter valid numbers!")
 
     def get_test_mode(self):
         """
@@ -101,7 +245,10 @@ class VelocityTestNode(Node):
             print("3. Exit")
             
             try:
-                choice = input("Enter your choice (1/2/3): ").strip()
+                choice = self._prompt("Enter your choice (1/2/3): ")
+                if choice is None:
+                    return 'exit'
+                choice = choice.strip()
                 
                 if choice == '1':
                     return 'linear'
@@ -114,55 +261,59 @@ class VelocityTestNode(Node):
             except KeyboardInterrupt:
                 return 'exit'
 
-    def get_linear_test_parameters(self):
+    def _get_params(self, label, unit):
         """
-        Get linear velocity test parameters from user
+        Get velocity test parameters from user
         """
         while True:
             try:
-                with self.ui_lock:
-                    print("\n--- Linear Velocity Test ---")
-                    velocity = float(input("Enter linear velocity (m/s): "))
-                    duration = float(input("Enter duration (seconds): "))
+                print(f"\n--- {label} Velocity Test ---")
+                last = self._last_params.get(label)
+                prompt = f"Enter {label.lower()} velocity ({unit}): "
+                if last is not None:
+                    prompt = (f"Enter {label.lower()} velocity ({unit}) "
+                              f"[Enter to reuse v={last[0]}, d={last[1]}]: ")
+                velocity = self._prompt_float(prompt, allow_empty=last is not None)
+                if velocity is None:
+                    return None, None
+                if velocity == '':
+                    return last
+                duration = self._prompt_float("Enter duration (seconds): ")
+                if duration is None:
+                    return None, None
                 
                 if duration <= 0:
-                    with self.ui_lock:
-                        print("Duration must be positive!")
+                    print("Duration must be positive!")
                     continue
                     
+                self._last_params[label] = (velocity, duration)
                 return velocity, duration
                 
-            except ValueError:
-                with self.ui_lock:
-                    print("Please enter valid numbers!")
             except KeyboardInterrupt:
                 return None, None
 
+    def get_linear_test_parameters(self):
+        """
+        Get linear velocity test parameters from user
+        """
+        return self._get_params('Linear', 'm/s')
+
     def get_angular_test_parameters(self):
         """
         Get angular velocity test parameters from user
         """
-        while True:
-            try:
-                with self.ui_lock:
-                    print("\n--- Angular Velocity Test ---")
-                    velocity = float(input("Enter angular velocity (rad/s): "))
-                    duration = float(input("Enter duration (seconds): "))
-                
-                if duration <= 0:
-                    with self.ui_lock:
-                        print("Duration must be positive!")
-                    continue
-                    
-                return velocity, duration
-                
-            except ValueError:
-                with self.ui_lock:
-                    print("Please enter valid numbers!")
-            except KeyboardInterrupt:
-                return None, None
+        return self._get_params('Angular', 'rad/s')
 
     def user_interface(self):
+        """
+        Run the user interface, releasing the stdin selector when it exits
+        """
+        try:
+            self._user_interface_loop()
+        finally:
+            self._sel.close()
+
+    def _user_interface_loop(self):
         """
         Main user interface loop
         """
@@ -171,7 +322,8 @@ class VelocityTestNode(Node):
         
         if self.test_mode == 'exit':
             self.get_logger().info('Exiting...')
-            rclpy.shutdown()
+            if rclpy.ok():
+                rclpy.shutdown()
             return
         
         # Main testing loop
@@ -180,61 +332,54 @@ class VelocityTestNode(Node):
                 if self.test_mode == 'linear':
                     velocity, duration = self.get_linear_test_parameters()
                     if velocity is not None and duration is not None:
-                        # Run test in separate thread to avoid blocking
-                        test_thread = threading.Thread(
-                            target=self.publish_velocity,
-                            args=(velocity, 0.0, duration)
-                        )
-                        test_thread.start()
-                        test_thread.join()  # Wait for test to complete
+                        # Publishing runs on the executor thread
+                        self.run_test(velocity, 0.0, duration)
                     else:
                         break
                         
                 elif self.test_mode == 'angular':
                     velocity, duration = self.get_angular_test_parameters()
                     if velocity is not None and duration is not None:
-                        # Run test in separate thread to avoid blocking
-                        test_thread = threading.Thread(
-                            target=self.publish_velocity,
-                            args=(0.0, velocity, duration)
-                        )
-                        test_thread.start()
-                        test_thread.join()  # Wait for test to complete
+                        # Publishing runs on the executor thread
+                        self.run_test(0.0, velocity, duration)
                     else:
                         break
                 
                 # Ask if user wants to continue
-                with self.ui_lock:
-                    print("\nTest completed!")
-                    continue_choice = input("Continue testing? (y/n): ").strip().lower()
-                if continue_choice not in ['y', 'yes']:
+                print("\nTest completed!")
+                continue_choice = self._prompt("Continue testing? (y/n): ")
+                if continue_choice is None:
+                    break
+                if continue_choice.strip().lower() not in ['y', 'yes']:
                     break
                     
             except KeyboardInterrupt:
                 break
         
-        with self.ui_lock:
-            print('Shutting down velocity test node...')
-        rclpy.shutdown()
+        print('Shutting down velocity test node...')
+        if rclpy.ok():
+            rclpy.shutdown()
 
 
 def main(args=None):
-    rclpy.init(args=args)
+    # Leave SIGINT to Python so the context is still valid when the stop goes out
+    rclpy.init(args=args, signal_handler_options=SignalHandlerOptions.NO)
     
     try:
         node = VelocityTestNode()
         
-        # Keep the node running
-        while rclpy.ok():
-            rclpy.spin_once(node, timeout_sec=0.1)
-            
-    except KeyboardInterrupt:
+        # Block in the executor until a timer, guard condition or shutdown wakes it
+        rclpy.spin(node)
+        
+    except (KeyboardInterrupt, ExternalShutdownException):
         pass
     finally:
         if 'node' in locals():
-            node.stop_robot()  # Ensure robot stops
+            if rclpy.ok() and node.is_publishing:
+                node.stop_robot()  # Ensure robot stops
             node.destroy_node()
-        rclpy.shutdown()
+        if rclpy.ok():
+            rclpy.shutdown()
 
 
 if __name__ == '__main__':